@@ -1,86 +1,622 @@
+import hashlib
+import math
 import os
+import queue
+import shutil
 import tempfile
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import faiss
+import numpy as np
 import streamlit as st
+import tiktoken
+from cachetools import TTLCache
+from streamlit.runtime.uploaded_file_manager import UploadedFile
+from langchain_core.documents import Document
 from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
-from langchain.text_splitter import CharacterTextSplitter
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy, maximal_marginal_relevance
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
 from dotenv import load_dotenv
-from langchain_community.document_loaders import PyPDFLoader
-from langchain.prompts import PromptTemplate
+from sentence_transformers import CrossEncoder
+from extracao_pdf import TRAVA_PDFIUM, carregar_pdf, contar_paginas, reiniciar_trava_pdfium
 
 # Carrega as variáveis de ambiente
 load_dotenv()
 
-# Inicializar o modelo de chat
-chat = ChatOpenAI(
-    api_key=os.getenv('OPENAI_API_KEY'), # Chave de API
-    model='gpt-4o' # Modelo LLM a ser usado
+# Tamanho de cada pedaço de texto e sobreposição entre pedaços consecutivos, em tokens
+TAMANHO_PEDACO = 512
+SOBREPOSICAO_PEDACO = 64
+# Modelo de embeddings, mais barato e rápido que o ada-002, e a quantidade de dimensões dos vetores gerados
+# (reduzida de 1536 para 512, encolhendo o índice FAISS); ambos fazem parte da chave do cache de bases vetoriais
+MODELO_EMBEDDINGS = 'text-embedding-3-small'
+DIMENSOES_EMBEDDINGS = 512
+# Limites da API de embeddings por requisição: quantidade de textos e total de tokens
+LIMITE_TEXTOS_REQUISICAO_EMBEDDINGS = 2048
+LIMITE_TOKENS_REQUISICAO_EMBEDDINGS = 300000
+# Tokens a mais que um pedaço pode ter ao ser recodificado pela API: a janela decodificada pode começar no meio
+# de uma palavra ou cortar um caractere multibyte, que não voltam exatamente aos mesmos tokens
+MARGEM_TOKENS_PEDACO = 64
+# Maior lote de pedaços que cabe em uma única requisição, mesmo que todos tenham o tamanho máximo mais a margem
+TAMANHO_LOTE_EMBEDDINGS = min(
+    LIMITE_TEXTOS_REQUISICAO_EMBEDDINGS,
+    LIMITE_TOKENS_REQUISICAO_EMBEDDINGS // (TAMANHO_PEDACO + MARGEM_TOKENS_PEDACO)
 )
+# Número máximo de processos usados na extração de texto dos PDFs
+MAXIMO_PROCESSOS_EXTRACAO = 8
+# Quantidade mínima de páginas por tarefa ao dividir um PDF grande entre os processos de extração
+PAGINAS_MINIMAS_POR_TAREFA = 50
+# Diretório onde as bases vetoriais já calculadas são salvas
+DIRETORIO_CACHE = 'cache'
+# Quantidade máxima de bases vetoriais mantidas em memória e tempo (em segundos) que cada uma fica lá;
+# as descartadas continuam no cache em disco e são recarregadas de lá se os mesmos PDFs forem enviados de novo
+MAXIMO_BASES_EM_MEMORIA = 8
+VALIDADE_BASES_EM_MEMORIA = 60 * 60
+# Incrementar sempre que a extração, a divisão em pedaços ou os embeddings mudarem, invalidando o cache
+VERSAO_CACHE = 13
+# Número máximo de requisições de embeddings simultâneas, para respeitar os limites de taxa da API
+REQUISICOES_EMBEDDINGS_SIMULTANEAS = 5
+# A partir desta quantidade de pedaços o índice IVF passa a ser usado no lugar do HNSW
+LIMITE_PEDACOS_HNSW = 10000
+# Quantidade máxima de perguntas e tempo (em segundos) que os fragmentos recuperados ficam em cache
+TAMANHO_CACHE_RECUPERACAO = 1024
+VALIDADE_CACHE_RECUPERACAO = 15 * 60
+# Modelo cross-encoder usado para reordenar os fragmentos candidatos pela relevância à pergunta
+MODELO_RERANKER = 'BAAI/bge-reranker-base'
+# Quantidade de mensagens mais recentes do histórico enviadas ao modelo junto com cada pergunta; as mais antigas
+# são descartadas em blocos desse tamanho, então podem ser enviadas até 2 × limite - 1 mensagens (veja janela_historico)
+LIMITE_MENSAGENS_HISTORICO = 10
+# Quantidade de mensagens mais recentes exibidas no chat enquanto o histórico completo não for solicitado
+LIMITE_MENSAGENS_EXIBIDAS = 50
+# Similaridade de cosseno mínima para considerar duas perguntas equivalentes e a quantidade máxima de respostas guardadas
+SIMILARIDADE_MINIMA_CACHE_RESPOSTAS = 0.9
+TAMANHO_CACHE_RESPOSTAS = 1000
+
+@st.cache_resource(show_spinner=False)
+def obter_chat():
+    """Cria uma única vez o modelo de chat, reaproveitado em todas as reexecuções do script."""
+
+    return ChatOpenAI(
+        api_key=os.getenv('OPENAI_API_KEY'), # Chave de API
+        model='gpt-4o' # Modelo LLM a ser usado
+    )
+
+@st.cache_resource(show_spinner=False)
+def obter_modelo_embeddings():
+    """Cria uma única vez o modelo de embeddings, reaproveitado em todas as reexecuções do script."""
+
+    return OpenAIEmbeddings(
+        model=MODELO_EMBEDDINGS,
+        dimensions=DIMENSOES_EMBEDDINGS,
+        chunk_size=TAMANHO_LOTE_EMBEDDINGS, # Quantidade de pedaços enviados em cada requisição
+        max_retries=6, # Repete requisições limitadas pela API (429) com espera exponencial, respeitando o Retry-After
+    )
+
+def _gerar_embeddings(modelo_embeddings, textos, ao_progredir):
+    """Gera os embeddings dos textos enviando os lotes à API de forma concorrente."""
+
+    # Divide os textos em lotes do tamanho aceito pelo modelo em cada requisição
+    tamanho_lote = modelo_embeddings.chunk_size
+    lotes = [textos[inicio:inicio + tamanho_lote] for inicio in range(0, len(textos), tamanho_lote)]
+
+    # Usa o cliente síncrono, que pode ser compartilhado entre threads; o cliente assíncrono do modelo em cache
+    # ficaria preso ao laço de eventos da primeira execução e ainda seria disputado por sessões simultâneas.
+    # O número de threads limita a quantidade de lotes em andamento ao mesmo tempo
+    with ThreadPoolExecutor(max_workers=REQUISICOES_EMBEDDINGS_SIMULTANEAS) as executor:
+        futuros = [executor.submit(modelo_embeddings.embed_documents, lote) for lote in lotes]
+        # Informa o progresso conforme cada lote termina, em qualquer ordem
+        for lotes_concluidos, _ in enumerate(as_completed(futuros), 1):
+            ao_progredir(f'Gerando embeddings ({lotes_concluidos}/{len(lotes)} lotes)...')
+
+    # Junta os vetores na ordem dos lotes, preservando a correspondência com os textos
+    return [vetor for futuro in futuros for vetor in futuro.result()]
+
+def _criar_indice(vetores):
+    """Cria um índice FAISS de busca aproximada por produto interno adequado à quantidade de vetores, já treinado.
+
+    Os vetores devem estar normalizados, de modo que o produto interno corresponda à similaridade de cosseno.
+    """
+
+    quantidade, dimensoes = vetores.shape
+
+    if quantidade < LIMITE_PEDACOS_HNSW:
+        # Grafo HNSW: busca sublinear, ideal para bases pequenas e médias
+        # Os vetores são armazenados quantizados em 8 bits por dimensão, um quarto da memória do float32
+        indice = faiss.IndexHNSWSQ(dimensoes, faiss.ScalarQuantizer.QT_8bit, 32, faiss.METRIC_INNER_PRODUCT)
+        # Constrói um grafo de melhor qualidade (mais vizinhos avaliados por inserção), feito uma única vez por base
+        indice.hnsw.efConstruction = 200
+        # Candidatos explorados em cada busca; precisa superar o fetch_k da recuperação para não perder resultados
+        indice.hnsw.efSearch = 64
+    else:
+        # Particiona os vetores em células de Voronoi e visita apenas as mais próximas da consulta;
+        # o k-means do FAISS precisa de ao menos 39 vetores por centroide, o que limita a quantidade de células
+        quantizador = faiss.IndexFlatIP(dimensoes)
+        celulas = min(int(4 * math.sqrt(quantidade)), quantidade // 39)
+        # Quantização por produto: cada vetor vira um código de 1 byte a cada 8 dimensões, 32 vezes menor que o float32;
+        # há vetores suficientes nesta faixa para treinar os 256 centroides de cada subquantizador
+        indice = faiss.IndexIVFPQ(quantizador, dimensoes, celulas, dimensoes // 8, 8, faiss.METRIC_INNER_PRODUCT)
+        indice.nprobe = 8 # Quantidade de células visitadas em cada busca
+        # A busca MMR reconstrói os vetores encontrados, o que no IVF exige o mapeamento direto
+        indice.make_direct_map()
+
+    # Os quantizadores aprendem com os próprios vetores (intervalos por dimensão ou centroides) antes de recebê-los
+    indice.train(vetores)
+    return indice
+
+def calcular_hash_pdfs(arquivos):
+    """Calcula um hash BLAKE2b do conteúdo dos arquivos enviados, usado como chave do cache de bases vetoriais."""
+
+    # Bases geradas por outra versão do processamento ou outro modelo de embeddings não são reaproveitadas
+    hash_pdfs = hashlib.blake2b(f'v{VERSAO_CACHE}:{MODELO_EMBEDDINGS}:{DIMENSOES_EMBEDDINGS}'.encode(), digest_size=32)
+    for arquivo in arquivos:
+        hash_pdfs.update(arquivo.getvalue())
+    return hash_pdfs.hexdigest()
+
+@st.cache_resource(show_spinner=False)
+def obter_codificador():
+    """Carrega uma única vez a codificação de tokens usada pelos modelos de embeddings da OpenAI."""
+
+    return tiktoken.get_encoding('cl100k_base')
+
+def dividir_em_pedacos(documentos, tamanho=TAMANHO_PEDACO, sobreposicao=SOBREPOSICAO_PEDACO):
+    """Divide as páginas em janelas de tokens com sobreposição, tokenizando todas as páginas uma única vez."""
+
+    codificador = obter_codificador()
 
-def obter_base_vetores_dos_pdfs(arquivos):
-    """Carrega o conteúdo de múltiplos arquivos PDF usando LangChain, divide o texto em pedaços e cria uma base vetorial."""
+    # Tokeniza todas as páginas em uma só chamada, processada em paralelo pelo código nativo do tiktoken
+    tokens_por_pagina = codificador.encode_ordinary_batch([documento.page_content for documento in documentos])
+
+    pedacos = []
+    for documento, tokens in zip(documentos, tokens_por_pagina):
+        # Páginas sem texto (como imagens digitalizadas) não geram pedaços
+        if not tokens:
+            continue
+
+        # Desliza a janela sobre os tokens da página; apenas os pedaços finais são decodificados de volta para texto
+        for inicio in range(0, max(len(tokens) - sobreposicao, 1), tamanho - sobreposicao):
+            pedacos.append(Document(
+                page_content=codificador.decode(tokens[inicio:inicio + tamanho]),
+                metadata={**documento.metadata, 'start_index': inicio} # Posição do pedaço na página, em tokens
+            ))
+
+    return pedacos
+
+def _gerar_pedacos_e_vetores(arquivos, modelo_embeddings, ao_progredir):
+    """Extrai o texto dos PDFs, divide em pedaços e gera os embeddings normalizados de cada pedaço."""
 
     # Lista para armazenar todos os documentos carregados
     documentos = []
 
-    # Cria arquivos temporários para cada PDF enviado
+    # Divide cada PDF em intervalos de páginas, para que também um único PDF grande seja extraído em paralelo.
+    # Cada tarefa leva o conteúdo inteiro do arquivo ao processo, então um PDF é dividido em no máximo
+    # um intervalo por processo, limitando as cópias dos bytes enviadas aos processos
+    processos_disponiveis = min(os.cpu_count() or 1, MAXIMO_PROCESSOS_EXTRACAO)
+    tarefas = []
     for arquivo in arquivos:
-        # Cria um arquivo temporário para salvar o conteúdo do arquivo enviado
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as arquivo_temporario:
-            arquivo_temporario.write(arquivo.getvalue())
-            caminho_arquivo = arquivo_temporario.name # Obtém o caminho do arquivo temporário
-
-        # Usa o PyPDFLoader do LangChain para carregar o PDF
-        carregador = PyPDFLoader(caminho_arquivo)
-        # Carrega o documento e adiciona à lista de documentos
-        documentos.extend(carregador.load())
-
-        # Remove o arquivo temporário após o carregamento
-        os.unlink(caminho_arquivo)
-
-    # Configura o divisor de texto em pedaços
-    divisor_texto = RecursiveCharacterTextSplitter(
-        separators=['\n\n', '\n', '.', ' ', ''], # Define o separador como uma quebra de linha
-        chunk_size=500, # Define o tamanho de cada pedaço de texto
-        chunk_overlap=200, # Define a sobreposição entre os pedaços
+        conteudo = arquivo.getvalue()
+        quantidade_paginas = contar_paginas(conteudo)
+        if quantidade_paginas is None:
+            # Sem a contagem do PDFium, o arquivo inteiro fica a cargo do pypdf em uma única tarefa
+            tarefas.append((arquivo.name, conteudo, 0, None))
+        else:
+            partes = max(1, min(processos_disponiveis, math.ceil(quantidade_paginas / PAGINAS_MINIMAS_POR_TAREFA)))
+            # Intervalos de tamanhos iguais, com no máximo uma página de diferença
+            limites = [quantidade_paginas * parte // partes for parte in range(partes + 1)]
+            tarefas.extend((arquivo.name, conteudo, inicio, fim) for inicio, fim in zip(limites, limites[1:]))
+
+    if len(tarefas) == 1:
+        # Uma única tarefa é processada aqui mesmo, sem o custo de iniciar um processo; as chamadas ao PDFium
+        # nesta thread são serializadas com as das outras sessões pela trava do módulo extracao_pdf
+        ao_progredir('Extraindo o texto do PDF...')
+        documentos.extend(carregar_pdf(*tarefas[0]))
+    else:
+        # A extração de texto é CPU-bound, então cada intervalo de páginas é processado em um processo separado
+        processos = min(len(tarefas), processos_disponiveis)
+        with ProcessPoolExecutor(max_workers=processos, initializer=reiniciar_trava_pdfium) as executor:
+            # Com o fork (padrão no Linux), os processos são criados no primeiro submit como cópias do servidor.
+            # Segurar a trava garante que nenhuma outra sessão esteja no meio de uma chamada ao PDFium nesse momento;
+            # a trava copiada já adquirida é substituída nos processos pelo inicializador
+            with TRAVA_PDFIUM:
+                futuros = [executor.submit(carregar_pdf, *tarefa) for tarefa in tarefas]
+            # Informa o progresso conforme cada intervalo termina, em qualquer ordem
+            for tarefas_concluidas, _ in enumerate(as_completed(futuros), 1):
+                ao_progredir(f'Extraindo o texto dos PDFs ({tarefas_concluidas}/{len(tarefas)} partes)...')
+
+        # Junta as páginas na mesma ordem dos arquivos enviados e das páginas de cada arquivo
+        for futuro in futuros:
+            documentos.extend(futuro.result())
+
+    # Divide o texto das páginas em pedaços
+    documentos_divididos = dividir_em_pedacos(documentos)
+
+    # Descarta pedaços idênticos, que só custariam embeddings e espaço no índice. Como cada pedaço é uma janela de tokens
+    # da página inteira, na prática isso remove páginas repetidas (inclusive entre arquivos), não cabeçalhos ou rodapés
+    # isolados; o texto é comparado sem diferenças de espaços, quebras de linha e maiúsculas
+    hashes_vistos = set()
+    documentos_unicos = []
+    for documento in documentos_divididos:
+        texto_normalizado = ' '.join(documento.page_content.split()).casefold()
+        hash_pedaco = hashlib.blake2b(texto_normalizado.encode(), digest_size=16).digest()
+        if hash_pedaco not in hashes_vistos:
+            hashes_vistos.add(hash_pedaco)
+            documentos_unicos.append(documento)
+    documentos_divididos = documentos_unicos
+
+    # PDFs sem texto extraível (como os digitalizados) não geram pedaços nem embeddings
+    if not documentos_divididos:
+        return [], np.empty((0, DIMENSOES_EMBEDDINGS), dtype=np.float32)
+
+    # Gera os embeddings dos pedaços com várias requisições em paralelo
+    textos = [documento.page_content for documento in documentos_divididos]
+    vetores = np.array(_gerar_embeddings(modelo_embeddings, textos, ao_progredir), dtype=np.float32)
+
+    # Normaliza os vetores para buscar por produto interno, que equivale ao cosseno sem calcular distâncias
+    faiss.normalize_L2(vetores)
+
+    return documentos_divididos, vetores
+
+def _criar_base_vetores(arquivos, modelo_embeddings, ao_progredir):
+    """Extrai o texto dos PDFs, divide em pedaços, gera os embeddings e monta a base vetorial."""
+
+    documentos_divididos, vetores = _gerar_pedacos_e_vetores(arquivos, modelo_embeddings, ao_progredir)
+
+    ao_progredir('Montando o índice vetorial...')
+
+    # Cria uma base vetorial persistente sobre um índice aproximado, em vez da busca exaustiva padrão
+    base_vetores = FAISS(
+        embedding_function=modelo_embeddings,
+        index=_criar_indice(vetores),
+        docstore=InMemoryDocstore(),
+        index_to_docstore_id={},
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
+    )
+    base_vetores.add_embeddings(
+        [(documento.page_content, vetor) for documento, vetor in zip(documentos_divididos, vetores)],
+        metadatas=[documento.metadata for documento in documentos_divididos]
     )
 
-    # Divide o texto do documento em pedaços
-    documentos_divididos = divisor_texto.split_documents(documentos)
+    return base_vetores
 
-    # Configura o modelo de embeddings para gerar representações vetoriais
-    modelo_embeddings = OpenAIEmbeddings()
+def _salvar_base_no_cache(base_vetores, caminho_cache):
+    """Salva a base vetorial no cache em disco de forma atômica, para que nunca seja lida uma base salva pela metade."""
+
+    # Grava em um diretório temporário e só então o renomeia para o caminho definitivo
+    os.makedirs(DIRETORIO_CACHE, exist_ok=True)
+    caminho_temporario = tempfile.mkdtemp(dir=DIRETORIO_CACHE)
+    base_vetores.save_local(caminho_temporario)
+    try:
+        os.replace(caminho_temporario, caminho_cache)
+    except OSError:
+        # Outra sessão salvou a mesma base primeiro; a cópia recém-gravada é descartada
+        shutil.rmtree(caminho_temporario, ignore_errors=True)
+
+@st.cache_resource(show_spinner=False)
+def obter_recursos_gpu():
+    """Cria uma única vez os recursos de GPU do FAISS, ou devolve None se não houver GPU disponível."""
+
+    # O pacote faiss-cpu não expõe os recursos de GPU
+    if not hasattr(faiss, 'StandardGpuResources') or faiss.get_num_gpus() == 0:
+        return None
+    return faiss.StandardGpuResources()
+
+def _mover_indice_para_gpu(indice):
+    """Move o índice para a GPU quando houver uma disponível e o tipo de índice for suportado nela."""
+
+    recursos_gpu = obter_recursos_gpu()
+    if recursos_gpu is None:
+        return indice
+
+    try:
+        indice_gpu = faiss.index_cpu_to_gpu(recursos_gpu, 0, indice)
+        # A busca MMR reconstrói os vetores encontrados, então a GPU precisa suportar essa operação
+        indice_gpu.reconstruct(0)
+    except RuntimeError:
+        # Índices sem implementação em GPU (como o HNSW) continuam na CPU
+        return indice
+    return indice_gpu
+
+def calcular_hash_arquivo(arquivo):
+    """Calcula um hash BLAKE2b do conteúdo de um arquivo enviado, que o identifica independentemente do nome."""
+
+    return hashlib.blake2b(arquivo.getvalue()).hexdigest()
+
+@st.cache_resource(
+    show_spinner=False,
+    hash_funcs={UploadedFile: calcular_hash_arquivo},
+    max_entries=MAXIMO_BASES_EM_MEMORIA,
+    ttl=VALIDADE_BASES_EM_MEMORIA
+)
+def obter_base_vetores_dos_pdfs(arquivos, _ao_progredir=lambda mensagem: None):
+    """Carrega o conteúdo de múltiplos arquivos PDF usando LangChain, divide o texto em pedaços e cria uma base vetorial.
+
+    A função _ao_progredir recebe mensagens sobre o andamento do processamento; o prefixo _ a exclui da chave do cache.
+    """
+
+    # Obtém o modelo de embeddings para gerar representações vetoriais
+    modelo_embeddings = obter_modelo_embeddings()
+
+    caminho_cache = os.path.join(DIRETORIO_CACHE, calcular_hash_pdfs(arquivos))
+    if os.path.isdir(caminho_cache):
+        # Reaproveita a base salva em disco se os mesmos PDFs já foram processados antes
+        base_vetores = FAISS.load_local(
+            caminho_cache,
+            modelo_embeddings,
+            allow_dangerous_deserialization=True,
+            distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
+        )
+    else:
+        base_vetores = _criar_base_vetores(arquivos, modelo_embeddings, _ao_progredir)
+        # Salva a base em disco, ainda na CPU, para evitar recalcular os embeddings dos mesmos PDFs
+        _salvar_base_no_cache(base_vetores, caminho_cache)
 
-    # Cria uma base vetorial persistente usando os textos em pedaços
-    base_vetores = FAISS.from_documents(documentos_divididos, modelo_embeddings)
+    # Acelera as buscas com a GPU, quando disponível
+    base_vetores.index = _mover_indice_para_gpu(base_vetores.index)
     return base_vetores
 
-def montar_prompt(fragmentos, pergunta):
-    """Monta manualmente o prompt com os fragmentos e o histórico de conversa."""
+def adicionar_pdfs_a_base(base_vetores, arquivos, ao_progredir=lambda mensagem: None):
+    """Devolve uma cópia da base vetorial acrescida dos pedaços dos novos PDFs, gerando embeddings apenas para eles.
+
+    A base recebida não é alterada, pois pode estar compartilhada com outras sessões pelo cache de obter_base_vetores_dos_pdfs.
+    Se nenhum texto for extraído dos novos PDFs, a própria base recebida é devolvida.
+    """
 
-    template = PromptTemplate.from_template("""
+    documentos_divididos, vetores = _gerar_pedacos_e_vetores(arquivos, base_vetores.embedding_function, ao_progredir)
+    if not documentos_divididos:
+        return base_vetores
+
+    ao_progredir('Adicionando os novos pedaços ao índice vetorial...')
+
+    # Copia o índice para a CPU, onde todos os tipos de índice aceitam novos vetores
+    if obter_recursos_gpu() is not None:
+        indice = faiss.index_gpu_to_cpu(base_vetores.index)
+    else:
+        indice = faiss.clone_index(base_vetores.index)
+
+    nova_base = FAISS(
+        embedding_function=base_vetores.embedding_function,
+        index=indice,
+        docstore=InMemoryDocstore(dict(base_vetores.docstore._dict)),
+        index_to_docstore_id=dict(base_vetores.index_to_docstore_id),
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
+    )
+    # O índice já treinado recebe os novos vetores sem ser reconstruído
+    nova_base.add_embeddings(
+        [(documento.page_content, vetor) for documento, vetor in zip(documentos_divididos, vetores)],
+        metadatas=[documento.metadata for documento in documentos_divididos]
+    )
+
+    nova_base.index = _mover_indice_para_gpu(nova_base.index)
+    return nova_base
+
+class AgrupadorBuscas:
+    """Agrupa as buscas de várias sessões no mesmo índice FAISS em uma única chamada ao index.search.
+
+    Todas as operações nos índices (busca e reconstrução dos vetores) rodam na thread do agrupador,
+    pois os recursos de GPU do FAISS não podem ser usados por várias threads ao mesmo tempo.
+    """
+
+    def __init__(self):
+        self.fila = queue.Queue()
+        # Uma única thread executa as buscas, de modo que as consultas que chegam enquanto uma busca
+        # está em andamento se acumulam na fila e são atendidas juntas na próxima chamada
+        threading.Thread(target=self._processar, daemon=True).start()
+
+    def buscar(self, indice, vetor, k):
+        """Enfileira a busca do vetor no índice e aguarda as posições encontradas e os vetores guardados nelas."""
+
+        futuro = Future()
+        self.fila.put((indice, vetor, k, futuro))
+        return futuro.result()
+
+    def _processar(self):
+        """Atende continuamente a fila de buscas, agrupando as consultas pendentes por índice."""
+
+        while True:
+            # Aguarda a primeira busca e junta todas as que já estiverem na fila, sem esperar por outras
+            pendentes = [self.fila.get()]
+            while not self.fila.empty():
+                pendentes.append(self.fila.get_nowait())
+
+            # Só é possível agrupar consultas feitas ao mesmo índice e com o mesmo k
+            grupos = {}
+            for busca in pendentes:
+                indice, _, k, _ = busca
+                grupos.setdefault((id(indice), k), []).append(busca)
+
+            for grupo in grupos.values():
+                indice, _, k, _ = grupo[0]
+                try:
+                    _, posicoes = indice.search(np.stack([vetor for _, vetor, _, _ in grupo]), k)
+                except Exception as erro:
+                    for *_, futuro in grupo:
+                        futuro.set_exception(erro)
+                    continue
+                for linha, (*_, futuro) in enumerate(grupo):
+                    try:
+                        # A posição -1 indica que o índice não tinha vetores suficientes
+                        posicoes_encontradas = [int(posicao) for posicao in posicoes[linha] if posicao != -1]
+                        # A busca MMR compara os vetores encontrados entre si, então eles são reconstruídos aqui mesmo
+                        vetores = [indice.reconstruct(posicao) for posicao in posicoes_encontradas]
+                    except Exception as erro:
+                        futuro.set_exception(erro)
+                    else:
+                        futuro.set_result((posicoes_encontradas, vetores))
+
+@st.cache_resource(show_spinner=False)
+def obter_agrupador_buscas():
+    """Cria um único agrupador de buscas compartilhado por todas as sessões."""
+
+    return AgrupadorBuscas()
+
+@st.cache_resource(show_spinner=False)
+def obter_reranker():
+    """Carrega uma única vez o modelo cross-encoder usado para reordenar os fragmentos recuperados."""
+
+    # Modelo pequeno o bastante para reordenar os poucos candidatos de cada pergunta na CPU em milissegundos
+    return CrossEncoder(MODELO_RERANKER, device='cpu')
+
+def reordenar_fragmentos(pergunta, fragmentos, k):
+    """Pontua cada fragmento junto com a pergunta no cross-encoder e mantém os k mais relevantes."""
+
+    pontuacoes = obter_reranker().predict([(pergunta, fragmento.page_content) for fragmento in fragmentos])
+    return [fragmentos[i] for i in np.argsort(pontuacoes)[::-1][:k]]
+
+def recuperar_fragmentos(base_vetores, pergunta, vetor_pergunta, k=2, candidatos=10, fetch_k=20):
+    """Recupera os fragmentos mais relevantes para a pergunta por relevância marginal máxima (MMR) e reordenação."""
+
+    # Busca os fetch_k vetores mais próximos do embedding normalizado da pergunta, junto com as buscas de outras sessões
+    vetor_pergunta = np.array(vetor_pergunta, dtype=np.float32)
+    vetor_pergunta /= np.linalg.norm(vetor_pergunta)
+    posicoes, vetores = obter_agrupador_buscas().buscar(base_vetores.index, vetor_pergunta, fetch_k)
+
+    # Seleciona os candidatos equilibrando a similaridade com a pergunta e a diversidade entre eles
+    selecionados = maximal_marginal_relevance(vetor_pergunta, vetores, k=candidatos)
+    fragmentos = [base_vetores.docstore.search(base_vetores.index_to_docstore_id[posicoes[i]]) for i in selecionados]
+
+    # O cross-encoder avalia pergunta e fragmento juntos, ordenando os candidatos com mais precisão que a busca vetorial
+    return reordenar_fragmentos(pergunta, fragmentos, k)
+
+@st.cache_resource(show_spinner=False)
+def obter_cache_recuperacao():
+    """Cria o cache de fragmentos recuperados, compartilhado entre as sessões, e a trava que o protege."""
+
+    return TTLCache(maxsize=TAMANHO_CACHE_RECUPERACAO, ttl=VALIDADE_CACHE_RECUPERACAO), threading.Lock()
+
+def recuperar_fragmentos_em_cache(chave_base, base_vetores, pergunta):
+    """Recupera o embedding e os fragmentos da pergunta, reaproveitando o resultado de uma consulta recente à mesma base."""
+
+    cache, trava = obter_cache_recuperacao()
+    # A chave da base (hash dos PDFs) separa as perguntas iguais feitas sobre documentos diferentes
+    chave = (chave_base, pergunta)
+    with trava:
+        resultado = cache.get(chave)
+    if resultado is None:
+        # Gera o embedding da pergunta uma única vez; ele também é usado pelo cache semântico de respostas.
+        # A busca roda fora da trava para não bloquear as outras sessões
+        vetor_pergunta = base_vetores.embedding_function.embed_query(pergunta)
+        resultado = (vetor_pergunta, recuperar_fragmentos(base_vetores, pergunta, vetor_pergunta))
+        with trava:
+            cache[chave] = resultado
+    return resultado
+
+@st.cache_resource(show_spinner=False)
+def obter_executor_recuperacao():
+    """Cria as threads compartilhadas que recuperam os fragmentos em segundo plano enquanto a página é montada."""
+
+    return ThreadPoolExecutor(thread_name_prefix='recuperacao')
+
+class CacheSemantico:
+    """Guarda as respostas do modelo e as reaproveita para perguntas equivalentes feitas sobre os mesmos trechos
+    e com as mesmas mensagens anteriores enviadas ao modelo."""
+
+    def __init__(self):
+        # O índice é criado na primeira resposta guardada, quando a dimensão dos vetores é conhecida
+        self.indice = None
+        # Para cada vetor do índice, a assinatura do contexto (trechos e mensagens anteriores) e a resposta gerada
+        self.entradas = []
+
+    def _assinatura(self, fragmentos, mensagens):
+        """Identifica o contexto da pergunta: os trechos usados e as mensagens anteriores enviadas ao modelo.
+
+        As mensagens entram na assinatura porque perguntas como "explique melhor" dependem da conversa,
+        e a resposta de outro momento da conversa não serve para elas.
+        """
+
+        hash_mensagens = hashlib.blake2b(digest_size=16)
+        for mensagem in mensagens:
+            hash_mensagens.update(f'{mensagem.type}\0{mensagem.content}\0'.encode())
+        return frozenset(fragmento.id for fragmento in fragmentos), hash_mensagens.digest()
+
+    def _normalizar(self, vetor_pergunta):
+        """Normaliza o vetor para que o produto interno do índice corresponda à similaridade de cosseno."""
+
+        vetor = np.array([vetor_pergunta], dtype=np.float32)
+        faiss.normalize_L2(vetor)
+        return vetor
+
+    def buscar(self, vetor_pergunta, fragmentos, mensagens):
+        """Devolve a resposta de uma pergunta semelhante feita sobre os mesmos fragmentos e mensagens anteriores, ou None."""
+
+        if self.indice is None or self.indice.ntotal == 0:
+            return None
+
+        assinatura = self._assinatura(fragmentos, mensagens)
+        similaridades, posicoes = self.indice.search(self._normalizar(vetor_pergunta), min(5, self.indice.ntotal))
+        for similaridade, posicao in zip(similaridades[0], posicoes[0]):
+            if similaridade < SIMILARIDADE_MINIMA_CACHE_RESPOSTAS:
+                break # Os resultados vêm em ordem decrescente de similaridade
+            if self.entradas[posicao][0] == assinatura:
+                return self.entradas[posicao][1]
+        return None
+
+    def adicionar(self, vetor_pergunta, fragmentos, mensagens, resposta):
+        """Guarda a resposta gerada para a pergunta, os fragmentos usados e as mensagens anteriores enviadas ao modelo."""
+
+        vetor = self._normalizar(vetor_pergunta)
+        if self.indice is None:
+            self.indice = faiss.IndexFlatIP(vetor.shape[1])
+
+        # Descarta a resposta mais antiga quando o cache está cheio; o índice renumera os vetores restantes
+        if self.indice.ntotal >= TAMANHO_CACHE_RESPOSTAS:
+            self.indice.remove_ids(np.array([0], dtype=np.int64))
+            self.entradas.pop(0)
+
+        self.indice.add(vetor)
+        self.entradas.append((self._assinatura(fragmentos, mensagens), resposta))
+
+# Instruções fixas enviadas ao LLM como primeira mensagem, antes da persona e do histórico, para que façam parte
+# do prefixo que se repete entre as perguntas (veja janela_historico)
+INSTRUCOES_PROMPT = """
     Use os trechos fornecidos para responder à pergunta do usuário de forma clara e concisa.
     Se necessário, complemente a resposta utilizando o histórico do chat.
     Se não souber a resposta com base nos trechos fornecidos e no histórico do chat, diga que não sabe, sem tentar adivinhar ou inventar informações.
     Se possível, seja direto e objetivo ao responder.
+    """
 
+# Modelo da mensagem de sistema com os trechos recuperados, enviada à parte, logo antes da pergunta
+TEMPLATE_PROMPT = """
     ### Trechos:
     {fragmentos}
+    """
+
+# Partes fixas do prompt, separadas uma única vez para que cada prompt seja montado sem reinterpretar o modelo
+INICIO_PROMPT, FIM_PROMPT = TEMPLATE_PROMPT.split('{fragmentos}')
+
+def montar_prompt(fragmentos):
+    """Monta manualmente a mensagem com os fragmentos recuperados para a pergunta atual."""
 
-    ### Pergunta:
-    {pergunta}
-    """)
+    # Ordena os fragmentos pela posição no documento, para que o mesmo conjunto de fragmentos gere sempre
+    # o mesmo texto, na ordem em que aparecem nos documentos
+    fragmentos = sorted(fragmentos, key=lambda fragmento: (
+        fragmento.metadata.get('source', ''),
+        fragmento.metadata.get('page', 0),
+        fragmento.metadata.get('start_index', 0)
+    ))
 
-    # Juntar todos os fragmentos em um único texto
-    contexto = '\n'.join([f'{indice}. {fragmento.page_content}\n' for indice, fragmento in enumerate(fragmentos,1)])
+    # Juntar todos os fragmentos em um único texto, separados por uma linha em branco
+    contexto = ''.join(f'{indice}. {fragmento.page_content}\n\n' for indice, fragmento in enumerate(fragmentos,1))
 
-    # Criar e formatar o prompt
-    prompt = template.format(fragmentos=contexto, pergunta=pergunta)
+    # Encaixa os fragmentos entre as partes fixas do prompt
+    prompt = ''.join([INICIO_PROMPT, contexto, FIM_PROMPT])
 
     return prompt
 
+def janela_historico(conversa, limite=LIMITE_MENSAGENS_HISTORICO):
+    """Seleciona as mensagens recentes da conversa enviadas ao modelo.
+
+    Em vez de deslizar a janela a cada pergunta, descarta as mensagens antigas em blocos de `limite`,
+    enviando no máximo 2 * `limite` - 1 mensagens. Assim o início das mensagens fica igual por
+    várias perguntas seguidas e o cache de prompts da OpenAI reaproveita o prefixo já processado.
+    A janela sempre começa em uma pergunta, para não enviar uma resposta cuja pergunta foi descartada.
+    """
+
+    inicio = max(len(conversa) - limite, 0) // limite * limite
+    if inicio > 0:
+        while inicio < len(conversa) and not isinstance(conversa[inicio], HumanMessage):
+            inicio += 1
+    return conversa[inicio:]
+
 def main():
     """Função principal para configurar e executar a interface da aplicação Streamlit."""
     # Inicializa o histórico de chat na sessão, se ainda não existir
@@ -89,9 +625,21 @@ def main():
     # Inicializa a base de vetores na sessão, se ainda não existir
     if 'base_vetores' not in st.session_state:
         st.session_state.base_vetores = None
+    # Inicializa a chave da base de vetores (hash dos PDFs processados), se ainda não existir
+    if 'chave_base' not in st.session_state:
+        st.session_state.chave_base = None
+    # Inicializa os hashes dos PDFs já incluídos na base de vetores, na ordem em que foram processados
+    if 'hashes_processados' not in st.session_state:
+        st.session_state.hashes_processados = []
+    # Inicializa o cache semântico de respostas do modelo, se ainda não existir
+    if 'cache_respostas' not in st.session_state:
+        st.session_state.cache_respostas = CacheSemantico()
     # Inicializa o estado de desabilitado do prompt se não existir
     if 'prompt_sistema_desabilitado' not in st.session_state:
         st.session_state.prompt_sistema_desabilitado = False
+    # Inicializa o indicador de prompt do sistema já adicionado ao histórico, se não existir
+    if 'sistema_adicionado' not in st.session_state:
+        st.session_state.sistema_adicionado = False
 
     # Configura o título e o ícone da página
     st.set_page_config(page_title='Chat com arquivos PDF', page_icon='🤖')
@@ -121,25 +669,97 @@ def main():
         # Se os arquivos foram enviados e o botão foi pressionado
         if arquivos_pdfs:
             if st.button('Processar PDFs', use_container_width=True):
-                # Mostra spinner durante processamento
-                with st.spinner('Processando documentos...'):
-                    # Adiciona o prompt do sistema primeiro se existir e não tiver sido adicionado ainda
-                    if prompt_sistema and not any(isinstance(m, SystemMessage) for m in st.session_state.historico_chat):
-                        st.session_state.historico_chat.insert(0, SystemMessage(content=prompt_sistema))
-                        # Desabilita o prompt após processar
-                        st.session_state.prompt_sistema_desabilitado = True
-
-                    # Inicializa o histórico de chat com a primeira mensagem do bot
-                    st.session_state.historico_chat.append(AIMessage(content='Olá, me faça perguntas a respeito do conteúdo carregado'))
-                    # Processa o PDF e gera a base vetorial
-                    st.session_state.base_vetores = obter_base_vetores_dos_pdfs(arquivos_pdfs)
-
-                # Mostra mensagem de sucesso após o processamento
-                st.success('Documentos processados com sucesso!')
+                # Identifica os PDFs enviados pelo conteúdo, descartando arquivos repetidos
+                arquivos_enviados = {calcular_hash_arquivo(arquivo): arquivo for arquivo in arquivos_pdfs}
+                # A base atual só é ampliada se todos os PDFs já processados continuam enviados;
+                # se algum foi removido, a base é recriada apenas com os PDFs atuais
+                ampliar_base = (
+                    st.session_state.base_vetores is not None
+                    and set(st.session_state.hashes_processados) <= arquivos_enviados.keys()
+                )
+                if ampliar_base:
+                    novos_arquivos = {
+                        hash_arquivo: arquivo for hash_arquivo, arquivo in arquivos_enviados.items()
+                        if hash_arquivo not in st.session_state.hashes_processados
+                    }
+                else:
+                    novos_arquivos = arquivos_enviados
+
+                if not novos_arquivos:
+                    st.info('Todos os PDFs enviados já foram processados.')
+                else:
+                    # Mostra o andamento de cada etapa durante o processamento
+                    with st.status('Processando documentos...') as status:
+                        # Adiciona o prompt do sistema primeiro se existir e não tiver sido adicionado ainda
+                        if prompt_sistema and not st.session_state.sistema_adicionado:
+                            st.session_state.historico_chat.insert(0, SystemMessage(content=prompt_sistema))
+                            st.session_state.sistema_adicionado = True
+                            # Desabilita o prompt após processar
+                            st.session_state.prompt_sistema_desabilitado = True
+
+                        if st.session_state.base_vetores is None:
+                            # Inicializa o histórico de chat com a primeira mensagem do bot
+                            st.session_state.historico_chat.append(AIMessage(content='Olá, me faça perguntas a respeito do conteúdo carregado'))
+
+                        # Indica que os novos PDFs não tinham texto extraível e a base continua a mesma
+                        sem_texto = False
+                        if ampliar_base:
+                            # Acrescenta à base atual apenas os pedaços dos novos PDFs
+                            base_ampliada = adicionar_pdfs_a_base(
+                                st.session_state.base_vetores,
+                                list(novos_arquivos.values()),
+                                lambda mensagem: status.update(label=mensagem)
+                            )
+                            sem_texto = base_ampliada is st.session_state.base_vetores
+                            st.session_state.base_vetores = base_ampliada
+                            st.session_state.hashes_processados.extend(novos_arquivos)
+                        else:
+                            # Processa os PDFs e gera a base vetorial
+                            st.session_state.base_vetores = obter_base_vetores_dos_pdfs(
+                                list(novos_arquivos.values()),
+                                lambda mensagem: status.update(label=mensagem)
+                            )
+                            st.session_state.hashes_processados = list(novos_arquivos)
+                        st.session_state.chave_base = hashlib.blake2b(''.join(st.session_state.hashes_processados).encode()).hexdigest()
+                        # Descarta as respostas geradas com a base anterior
+                        st.session_state.cache_respostas = CacheSemantico()
+
+                        # Recolhe o painel de andamento ao final do processamento
+                        status.update(label='Documentos processados', state='complete')
+
+                    if sem_texto:
+                        st.warning('Nenhum texto pôde ser extraído dos novos PDFs (por exemplo, PDFs digitalizados); a base não foi alterada.')
+                    else:
+                        # Mostra mensagem de sucesso após o processamento
+                        st.success('Documentos processados com sucesso!')
 
     if st.session_state.base_vetores is not None:
+        # A pergunta enviada já está no estado da sessão no início da execução; a recuperação dos fragmentos
+        # começa em segundo plano, reaproveitando os de uma pergunta recente igual, enquanto o histórico é exibido
+        pergunta = st.session_state.get('pergunta')
+        if pergunta:
+            recuperacao = obter_executor_recuperacao().submit(
+                recuperar_fragmentos_em_cache,
+                st.session_state.chave_base,
+                st.session_state.base_vetores,
+                pergunta
+            )
+
+        # Exibe apenas as mensagens mais recentes, para que cada execução não redesenhe toda a conversa;
+        # o prompt do sistema não aparece no chat e por isso não entra na contagem
+        mensagens_exibidas = [
+            mensagem for mensagem in st.session_state.historico_chat
+            if isinstance(mensagem, (AIMessage, HumanMessage))
+        ]
+        mensagens_ocultas = len(mensagens_exibidas) - LIMITE_MENSAGENS_EXIBIDAS
+        if mensagens_ocultas > 0:
+            rotulo = 'Mostrar a mensagem anterior' if mensagens_ocultas == 1 else f'Mostrar as {mensagens_ocultas} mensagens anteriores'
+            # O botão só fica ativo na execução causada pelo clique, então o limite volta na próxima interação
+            if not st.button(rotulo):
+                mensagens_exibidas = mensagens_exibidas[-LIMITE_MENSAGENS_EXIBIDAS:]
+
         # Exibe o histórico do chat na interface
-        for mensagem in st.session_state.historico_chat:
+        for mensagem in mensagens_exibidas:
             if isinstance(mensagem, AIMessage): # Mensagem do chatbot
                 with st.chat_message('ai'):
                     st.write(mensagem.content)
@@ -148,10 +768,10 @@ def main():
                     st.write(mensagem.content)
 
         # Captura a entrada do usuário no chat
-        pergunta = st.chat_input('Digite sua mensagem aqui...')
+        st.chat_input('Digite sua mensagem aqui...', key='pergunta')
 
         # Processa a mensagem do usuário e gera resposta
-        if pergunta is not None and pergunta != '':
+        if pergunta:
             # Exibir a pergunta do usuário no chat
             with st.chat_message('human'):
                 st.write(pergunta)
@@ -163,30 +783,54 @@ def main():
                 # Exibe uma mensagem temporária no chat enquanto os documentos relevantes são recuperados com base na pergunta do usuário.
                 placeholder.write('Recuperando...')
 
-                # Recuperar documentos relevantes com base na pergunta usando o banco vetorial
-                documentos_relevantes = st.session_state.base_vetores.max_marginal_relevance_search(pergunta, k=3, fetch_k=10)
-
-                # Exibe uma mensagem temporária no chat indicando que o modelo está processando a resposta com base nos fragmentos recuperados.
-                placeholder.write('Gerando resposta...')
-
-                # Montar o prompt com os fragmentos
-                prompt = montar_prompt(documentos_relevantes, pergunta)
-
-                # Adiciona o prompt com os trechos e a pergunta ao histórico
-                st.session_state.historico_chat.append(HumanMessage(content=prompt))
-
-                # Obtém resposta do modelo considerando o histórico
-                resposta = chat.stream(st.session_state.historico_chat)
-
-                # Inicializa uma string para armazenar a resposta completa
-                resposta_completa = ''
-
-                # Acumula as partes da resposta
-                for parte in placeholder.write_stream(resposta):
-                    resposta_completa += parte # Acumula o texto gerado
-
-            # Limpa o histórico antes de adicionar a resposta, removendo o prompt montado
-            st.session_state.historico_chat.pop() # Remove a última, que seria o prompt montado
+                # Aguarda os documentos relevantes recuperados do banco vetorial com base na pergunta
+                vetor_pergunta, documentos_relevantes = recuperacao.result()
+
+                # Seleciona as instruções fixas, a persona e as mensagens recentes do histórico enviadas ao modelo
+                historico = st.session_state.historico_chat
+                sistema = historico[:1] if st.session_state.sistema_adicionado else []
+                mensagens_anteriores = [
+                    SystemMessage(content=INSTRUCOES_PROMPT),
+                    *sistema,
+                    *janela_historico(historico[len(sistema):])
+                ]
+
+                # Procura a resposta de uma pergunta equivalente já feita sobre os mesmos trechos, no mesmo ponto da conversa
+                resposta_completa = st.session_state.cache_respostas.buscar(
+                    vetor_pergunta, documentos_relevantes, mensagens_anteriores
+                )
+
+                if resposta_completa is not None:
+                    # Exibe a resposta guardada, sem chamar o modelo
+                    placeholder.write(resposta_completa)
+                else:
+                    # Exibe uma mensagem temporária no chat indicando que o modelo está processando a resposta com base nos fragmentos recuperados.
+                    placeholder.write('Gerando resposta...')
+
+                    # Montar o prompt com os fragmentos
+                    prompt = montar_prompt(documentos_relevantes)
+
+                    # Monta as mensagens do modelo com as instruções, a persona, as mensagens recentes do histórico, os trechos em uma
+                    # mensagem de sistema temporária e a pergunta. O histórico guarda só perguntas e respostas, então
+                    # os trechos de cada pergunta são enviados uma única vez e o custo de cada pergunta não cresce com a conversa
+                    mensagens_llm = [
+                        *mensagens_anteriores,
+                        SystemMessage(content=prompt),
+                        HumanMessage(content=pergunta)
+                    ]
+
+                    # Obtém resposta do modelo considerando o histórico recente, token a token
+                    resposta = obter_chat().stream(mensagens_llm)
+
+                    # Exibe a resposta conforme é gerada; write_stream já devolve o texto completo
+                    resposta_completa = placeholder.write_stream(parte.content for parte in resposta)
+
+                    # Guarda a resposta para perguntas equivalentes futuras
+                    st.session_state.cache_respostas.adicionar(
+                        vetor_pergunta, documentos_relevantes, mensagens_anteriores, resposta_completa
+                    )
+
+            # Registra no histórico apenas a pergunta e a resposta, sem os trechos recuperados
             st.session_state.historico_chat.append(HumanMessage(content=pergunta)) # Adiciona apenas a pergunta ao histórico
             st.session_state.historico_chat.append(AIMessage(content=resposta_completa)) # Adicionar a resposta do modelo ao histórico de mensagens
 
@@ -0,0 +1,76 @@
+import io
+import threading
+import pypdf
+import pypdfium2 as pdfium
+from langchain_core.documents import Document
+
+# As funções deste módulo são executadas nos processos de extração. Elas ficam fora do app.py porque o Streamlit
+# recria o módulo do script a cada reexecução, e as funções dele deixariam de ser serializáveis pelo pickle
+
+# O PDFium não é thread-safe e cada sessão do Streamlit roda em uma thread própria, então todas as chamadas a ele
+# no processo do servidor passam por esta trava
+TRAVA_PDFIUM = threading.Lock()
+
+def reiniciar_trava_pdfium():
+    """Inicializa um processo de extração com uma trava nova.
+
+    Criado por fork, o processo herda a TRAVA_PDFIUM no estado em que estava no servidor, possivelmente
+    adquirida por uma thread que não existe no processo filho e nunca a liberaria.
+    """
+
+    global TRAVA_PDFIUM
+    TRAVA_PDFIUM = threading.Lock()
+
+def contar_paginas(conteudo):
+    """Conta as páginas de um PDF com o PDFium, ou devolve None se ele não conseguir abrir o arquivo."""
+
+    with TRAVA_PDFIUM:
+        try:
+            pdf = pdfium.PdfDocument(conteudo)
+        except pdfium.PdfiumError:
+            return None
+        try:
+            return len(pdf)
+        finally:
+            pdf.close()
+
+def carregar_pdf_pypdf(conteudo, inicio=0, fim=None):
+    """Extrai as páginas de um PDF com o pypdf, usado quando o PDFium não consegue abrir o arquivo."""
+
+    # Lê o PDF direto da memória, sem gravá-lo em um arquivo temporário
+    leitor = pypdf.PdfReader(io.BytesIO(conteudo))
+    return [
+        Document(page_content=pagina.extract_text() or '', metadata={'page': indice})
+        for indice, pagina in enumerate(leitor.pages[inicio:fim], inicio)
+    ]
+
+def carregar_pdf(nome, conteudo, inicio=0, fim=None):
+    """Carrega as páginas de inicio a fim (exclusivo) de um PDF a partir do seu conteúdo em bytes (executada em um processo separado)."""
+
+    with TRAVA_PDFIUM:
+        try:
+            # O PDFium extrai o texto em código nativo, bem mais rápido que o parser em Python puro
+            pdf = pdfium.PdfDocument(conteudo)
+        except pdfium.PdfiumError:
+            paginas = None
+        else:
+            paginas = []
+            try:
+                for indice in range(inicio, len(pdf) if fim is None else fim):
+                    pagina = pdf[indice]
+                    pagina_texto = pagina.get_textpage()
+                    paginas.append(Document(page_content=pagina_texto.get_text_range(), metadata={'page': indice}))
+                    pagina_texto.close()
+                    pagina.close()
+            finally:
+                pdf.close()
+
+    if paginas is None:
+        # Recorre ao pypdf, fora da trava, apenas se o PDFium não conseguir interpretar o arquivo
+        paginas = carregar_pdf_pypdf(conteudo, inicio, fim)
+
+    # Identifica as páginas pelo nome do arquivo enviado
+    for pagina in paginas:
+        pagina.metadata['source'] = nome
+
+    return paginas